@@ -1,12 +1,64 @@
 # Grading using Gemini (default) or a dummy fallback.
 # Set GRADER_MODE=gemini (recommended) and provide GEMINI_API_KEY and GEMINI_MODEL
 # Default model can be overridden by env; you can set GEMINI_MODEL=gemini-2.5-flash if available.
+# Blank or too-short answers (MIN_CHARS), and multiple-choice answers when the rubric carries an answer key
+# (rubric["multiple_choice"]["answer_key"] = {"<question_id>": "<expected>"}), are graded locally.
 
 from typing import Any, Dict, List, Tuple
-import os, json
+import os, asyncio, hashlib, logging, time
+import orjson
+from google.api_core.exceptions import GoogleAPICallError, ResourceExhausted, ServiceUnavailable
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+
+from app import llm_cache
+
+try:
+    from opentelemetry import trace  # optional: token usage is attached to the active span
+except ImportError:
+    trace = None
+
+logger = logging.getLogger(__name__)
 
 GRADER_MODE = os.getenv("GRADER_MODE", "gemini")  # 'gemini' | 'dummy'
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+# Max in-flight Gemini requests per grading run; throughput flattens out past ~8
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+GEMINI_BATCH_SIZE = 10  # answers per Gemini request (keep <= 100)
+
+# Answers shorter than this (stripped) score 0 without a Gemini call; other types: 1
+MIN_CHARS = {"essay": 40, "coding": 20, "multiple_choice": 1}
+
+# USD per 1M tokens (Gemini 2.0 Flash list price); override via env when pricing changes
+GEMINI_INPUT_PRICE_PER_M = float(os.getenv("GEMINI_INPUT_PRICE_PER_M", "0.15"))
+GEMINI_OUTPUT_PRICE_PER_M = float(os.getenv("GEMINI_OUTPUT_PRICE_PER_M", "0.60"))
+# Tokens served from a context cache are billed at 10% of the input price
+GEMINI_CACHED_INPUT_PRICE_PER_M = float(os.getenv("GEMINI_CACHED_INPUT_PRICE_PER_M", "0.015"))
+
+# Explicit context caching of the rubric preamble. Gemini rejects caches below a
+# minimum size, so small rubrics rely on implicit (prefix) caching instead.
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))  # seconds; 0 disables
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "4096"))
+
+# Structured output: Gemini returns bare JSON matching these, no prose to strip
+_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "score": {"type": "number"},
+        "rationale": {"type": "string"},
+        "tags": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["score", "rationale"]
+}
+
+# Batched requests: one object per answer, keyed by its question identifier
+_BATCH_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {"question_id": {"type": "string"}, **_RESPONSE_SCHEMA["properties"]},
+        "required": ["question_id", *_RESPONSE_SCHEMA["required"]]
+    }
+}
 
 def _dummy_grade(answers: List[Dict[str, Any]], rubric: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], Dict[str, Any], Dict[str, float]]:
     out = []
@@ -22,70 +74,317 @@ def _dummy_grade(answers: List[Dict[str, Any]], rubric: Dict[str, Any]) -> Tuple
     cost = {"input_tokens": 0, "output_tokens": 0, "usd": 0.0}
     return out, overall, cost
 
-def _gemini_grade(answers: List[Dict[str, Any]], rubric: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], Dict[str, Any], Dict[str, float]]:
-    import google.generativeai as genai
-    import logging
+def _result(a: Dict[str, Any], score: float, rationale: str, tags: List[str] | None = None) -> Dict[str, Any]:
+    return {
+        "question_type": a["question_type"],
+        "question_id": a["question_id"],
+        "score": score,
+        "rationale": rationale,
+        "tags": tags or []
+    }
 
-    logger = logging.getLogger(__name__)
+def _extract_json(s: str) -> str | None:
+    """Return the first balanced {...} span in s, or None.
 
-    try:
-        api_key = os.environ["GEMINI_API_KEY"]
-        genai.configure(api_key=api_key)
-    except KeyError:
-        logger.error("GEMINI_API_KEY environment variable not set")
-        return _fallback_grade(answers, rubric, "API key not configured")
+    Single linear pass tracking brace depth; braces inside string literals
+    (including escaped quotes) are ignored. Quotes outside any object are
+    treated as prose.
+    """
+    depth = 0
+    start = -1
+    in_str = False
+    escaped = False
+    for i, ch in enumerate(s):
+        if in_str:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = depth > 0
+        elif ch == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif ch == "}" and depth:
+            depth -= 1
+            if depth == 0:
+                return s[start:i + 1]
+    return None
 
+def _decode_json(raw_text: str) -> Any:
+    """Decode a Gemini response. Structured output makes it bare JSON; a stream
+    stopped mid-chunk may carry a tail after the object, so fall back to the
+    balanced span the stream stopped at."""
     try:
-        model = genai.GenerativeModel(GEMINI_MODEL)
-    except Exception as e:
-        logger.error(f"Failed to initialize Gemini model: {e}")
-        return _fallback_grade(answers, rubric, f"Model initialization failed: {e}")
+        return orjson.loads(raw_text)
+    except orjson.JSONDecodeError:
+        pass
+    span = _extract_json(raw_text)
+    if span:
+        try:
+            return orjson.loads(span)
+        except orjson.JSONDecodeError:
+            pass
+    return {}
 
-    per_q: List[Dict[str, Any]] = []
-    total = 0.0
-    total_input_tokens = 0
-    total_output_tokens = 0
-    failed_questions = 0
+def _parse_grade(js: Any) -> Tuple[float, str, bool]:
+    """Extract (score, rationale, parsed) from a decoded Gemini JSON object."""
+    score = 0.0
+    rationale = "Grading failed - unable to parse AI response"
+    parsed = False
 
-    for a in answers:
-        prompt = f"""
-You are a strict grader. Rubric (JSON): {json.dumps(rubric or {})}
-Question identifier: {a['question_type']}:{a['question_id']}
+    if isinstance(js, dict):
+        # Try different possible keys for score
+        # First key present with a value; `or` would treat a real 0 score as missing
+        score_value = next((js[k] for k in ("score", "grade", "rating") if js.get(k) is not None), None)
+        if score_value is not None:
+            try:
+                score = float(score_value)
+                # Clamp to 0-1 range
+                score = max(0.0, min(1.0, score))
+                parsed = True
+            except (ValueError, TypeError):
+                pass
+
+        rationale_value = js.get("rationale") or js.get("explanation") or js.get("feedback") or js.get("comment")
+        if rationale_value:
+            rationale = str(rationale_value)[:500]  # Limit length
+
+    return score, rationale, parsed
+
+_MODEL = None
+
+def _model():
+    """Configure genai and build the GenerativeModel once per process so every
+    request shares the SDK's client and its pooled connections."""
+    global _MODEL
+    if _MODEL is None:
+        import google.generativeai as genai
+        # Leave transport at its default: async calls then use grpc_asyncio, which
+        # multiplexes every concurrent request over one HTTP/2 channel. "rest"
+        # would open an HTTP/1.1 connection (and TLS handshake) per in-flight call.
+        genai.configure(api_key=os.environ["GEMINI_API_KEY"])
+        _MODEL = genai.GenerativeModel(GEMINI_MODEL)
+    return _MODEL
+
+# Prompt templates, filled with str.format_map; {preamble} is the rubric preamble,
+# or empty when the rubric lives in a context cache
+_PREAMBLE_TMPL = "You are a strict grader. Rubric (JSON): {rubric_json}\n"
+
+_PROMPT_TMPL = """{preamble}Question identifier: {ident}
 Student answer:
-{a['answer_text']}
+{answer}
 
 Return a JSON object with:
 - "score": a float from 0 to 1
 - "rationale": a short sentence explaining the score
+- "tags": short labels for notable issues (may be empty)
 """
 
-        try:
-            resp = model.generate_content(
-                [{"role":"user","parts":[{"text": prompt}]}],
-                generation_config={"temperature": 0.2, "max_output_tokens": 200},
-                safety_settings=None
-            )
-        except Exception as e:
-            logger.warning(f"Gemini API call failed for question {a['question_id']}: {e}")
-            failed_questions += 1
-            # Use fallback scoring for this question
-            score = 0.5  # Neutral fallback score
-            rationale = f"Grading failed due to API error: {str(e)[:100]}"
-            per_q.append({
-                "question_type": a["question_type"],
-                "question_id": a["question_id"],
-                "score": score,
-                "rationale": rationale,
-                "tags": ["api_error"]
-            })
-            total += score
-            continue
-
-        # Capture usage metadata
+_BATCH_ITEM_TMPL = "{n}. Question identifier: {ident}\nStudent answer:\n{answer}"
+
+_BATCH_PROMPT_TMPL = """{preamble}
+Grade each of the following student answers independently.
+
+{items}
+
+Return a JSON array with one object per answer, each with:
+- "question_id": the question identifier exactly as given above
+- "score": a float from 0 to 1
+- "rationale": a short sentence explaining the score
+- "tags": short labels for notable issues (may be empty)
+"""
+
+def _preamble(rubric_json: str) -> str:
+    # Shared by every prompt of a run and kept first, so it is the cacheable prefix
+    return _PREAMBLE_TMPL.format_map({"rubric_json": rubric_json})
+
+# sha256(rubric_json) -> (model bound to the cached preamble or None, refresh deadline);
+# at most _CONTEXT_CACHES_MAX rubrics, oldest evicted first
+_CONTEXT_CACHES: Dict[str, Tuple[Any, float]] = {}
+_CONTEXT_CACHES_MAX = 256
+
+async def _context_model(rubric_json: str) -> Any:
+    """GenerativeModel whose CachedContent holds the rubric preamble, or None when
+    the rubric is too small to cache or cache creation failed."""
+    if GEMINI_CONTEXT_CACHE_TTL <= 0 or len(rubric_json) // 4 < GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+        return None
+
+    key = hashlib.sha256(rubric_json.encode()).hexdigest()
+    now = time.monotonic()
+    entry = _CONTEXT_CACHES.get(key)
+    if entry and entry[1] > now:
+        return entry[0]
+
+    import google.generativeai as genai
+    try:
+        cache = await asyncio.to_thread(
+            genai.caching.CachedContent.create,
+            model=GEMINI_MODEL,
+            display_name=f"rubric-{key[:16]}",
+            contents=[_preamble(rubric_json)],
+            ttl=GEMINI_CONTEXT_CACHE_TTL
+        )
+        model = genai.GenerativeModel.from_cached_content(cache)
+    except Exception as e:
+        # Remember the failure for the TTL too, so every job doesn't retry creation
+        logger.info("Context cache unavailable for rubric %s: %s", key[:12], e)
+        model = None
+
+    # Refresh a minute early so requests never reference an expired cache
+    _CONTEXT_CACHES.pop(key, None)
+    while len(_CONTEXT_CACHES) >= _CONTEXT_CACHES_MAX:
+        del _CONTEXT_CACHES[next(iter(_CONTEXT_CACHES))]
+    _CONTEXT_CACHES[key] = (model, now + max(GEMINI_CONTEXT_CACHE_TTL - 60, 0))
+    return model
+
+def _matches_key(answer: str, expected: Any) -> bool:
+    # Numeric keys compare as numbers ("4" == "4.0"), everything else case-insensitively
+    try:
+        return float(answer) == float(expected)
+    except (TypeError, ValueError):
+        return answer.casefold() == str(expected).strip().casefold()
+
+def _grade_locally(a: Dict[str, Any], rubric: Dict[str, Any]) -> Dict[str, Any] | None:
+    """Grade answers whose outcome needs no LLM; None means ask Gemini."""
+    text = (a.get("answer_text") or "").strip()
+    if not text:
+        return _result(a, 0.0, "No answer provided.", ["empty"])
+    if len(text) < MIN_CHARS.get(a["question_type"], 1):
+        return _result(a, 0.0, "No substantive answer.", ["empty"])
+
+    if a["question_type"] == "multiple_choice":
+        # rubric is free-form; anything but {"answer_key": {...}} means no key
+        mc = rubric.get("multiple_choice")
+        answer_key = mc.get("answer_key") if isinstance(mc, dict) else None
+        if not isinstance(answer_key, dict):
+            return None
+        expected = answer_key.get(str(a["question_id"]))
+        if expected is not None:
+            if _matches_key(text, expected):
+                return _result(a, 1.0, "Matches the answer key.")
+            return _result(a, 0.0, "Does not match the answer key.")
+
+    return None
+
+_backoff = wait_random_exponential(min=0.5, max=8)
+
+def _retry_after(exc: BaseException | None) -> float | None:
+    """Server-suggested delay: gRPC RetryInfo detail or a REST Retry-After header."""
+    for detail in getattr(exc, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None and hasattr(delay, "seconds"):
+            return delay.seconds + delay.nanos / 1e9
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+def _wait(retry_state) -> float:
+    delay = _retry_after(retry_state.outcome.exception())
+    return min(delay, 30.0) if delay is not None else _backoff(retry_state)
+
+@retry(
+    retry=retry_if_exception_type((ResourceExhausted, ServiceUnavailable)),
+    wait=_wait,
+    stop=stop_after_attempt(4),
+    reraise=True
+)
+async def _call_once(model: Any, prompt: str, **kwargs: Any) -> Any:
+    """One Gemini request; 429/503 are retried with jittered backoff, other errors raise."""
+    return await model.generate_content_async(
+        [{"role":"user","parts":[{"text": prompt}]}],
+        safety_settings=None,
+        **kwargs
+    )
+
+async def _gemini_grade(answers: List[Dict[str, Any]], rubric: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], Dict[str, Any], Dict[str, float]]:
+    try:
+        model = _model()
+    except KeyError:
+        logger.error("GEMINI_API_KEY environment variable not set")
+        return _fallback_grade(answers, rubric, "API key not configured")
+    except Exception as e:
+        logger.error("Failed to initialize Gemini model: %s", e)
+        return _fallback_grade(answers, rubric, f"Model initialization failed: {e}")
+
+    # Serialize the rubric once per run; sorted keys also make it a stable cache-key part
+    rubric_json = orjson.dumps(rubric or {}, option=orjson.OPT_SORT_KEYS).decode()
+
+    # Large rubrics go into an explicit context cache and are sent once per TTL;
+    # otherwise the preamble is inlined ahead of each prompt
+    cached_model = await _context_model(rubric_json)
+    if cached_model is not None:
+        model, preamble = cached_model, ""
+    else:
+        preamble = _preamble(rubric_json)
+
+    # Bound in-flight requests so large exams don't trip Gemini rate limits; retries
+    # happen inside the slot, so backoff can't fan out into a retry storm
+    sem = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+    # Token usage across every request made for this grading run
+    usage_totals = {"input_tokens": 0, "cached_input_tokens": 0, "output_tokens": 0}
+
+    # Successful parses, written to the response cache in one round trip at the end;
+    # failures aren't cached so they're retried against the API
+    to_cache: Dict[str, Dict[str, Any]] = {}
+
+    def _record_usage(resp: Any) -> None:
         usage = getattr(resp, 'usage_metadata', None)
         if usage:
-            total_input_tokens += getattr(usage, 'prompt_token_count', 0)
-            total_output_tokens += getattr(usage, 'candidates_token_count', 0)
+            # prompt_token_count includes the cached tokens
+            usage_totals["input_tokens"] += getattr(usage, 'prompt_token_count', 0)
+            usage_totals["cached_input_tokens"] += getattr(usage, 'cached_content_token_count', 0)
+            usage_totals["output_tokens"] += getattr(usage, 'candidates_token_count', 0)
+
+    def _failed(a: Dict[str, Any], rationale: str, tag: str) -> Dict[str, Any]:
+        # Neutral fallback score for questions we could not grade
+        return _result(a, 0.5, rationale, [tag])
+
+    def _ident(a: Dict[str, Any]) -> str:
+        return f"{a['question_type']}:{a['question_id']}"
+
+    async def grade_one(a: Dict[str, Any], cache_key: str) -> Tuple[Dict[str, Any], bool]:
+        """Grade a single answer; returns (result, failed)."""
+        prompt = _PROMPT_TMPL.format_map({"preamble": preamble, "ident": _ident(a), "answer": a["answer_text"]})
+
+        # Stream the response; text is collected only until the object is complete
+        parts: List[str] = []
+        complete = False
+        try:
+            async with sem:
+                resp = await _call_once(
+                    model, prompt,
+                    generation_config={
+                        "temperature": 0.2,
+                        "max_output_tokens": 200,
+                        "response_mime_type": "application/json",
+                        "response_schema": _RESPONSE_SCHEMA
+                    },
+                    stream=True
+                )
+                async for chunk in resp:
+                    # Keep draining once the JSON has arrived, without parsing: final
+                    # usage and finish_reason only come with the last chunk
+                    if complete:
+                        continue
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        continue  # chunk without text parts (finish reason / usage only)
+                    parts.append(text)
+                    complete = "}" in text and _extract_json("".join(parts)) is not None
+        except Exception as e:
+            logger.warning("Gemini API call failed for question %s: %s", a['question_id'], e)
+            return _failed(a, f"Grading failed due to API error: {str(e)[:100]}", "api_error"), True
+
+        # Capture usage metadata (final once the stream is drained)
+        _record_usage(resp)
 
         # Check if response was blocked by safety filters
         raw_text = ""
@@ -93,88 +392,142 @@ Return a JSON object with:
             candidate = resp.candidates[0]
             if hasattr(candidate, 'finish_reason') and candidate.finish_reason:
                 if str(candidate.finish_reason) in ['SAFETY', 'RECITATION']:
-                    logger.warning(f"Gemini response blocked for question {a['question_id']}: {candidate.finish_reason}")
+                    logger.warning("Gemini response blocked for question %s: %s", a['question_id'], candidate.finish_reason)
                     # Use fallback scoring for blocked content
-                    score = 0.5
-                    rationale = f"Content blocked by safety filters: {candidate.finish_reason}"
-                    per_q.append({
-                        "question_type": a["question_type"],
-                        "question_id": a["question_id"],
-                        "score": score,
-                        "rationale": rationale,
-                        "tags": ["safety_blocked"]
-                    })
-                    total += score
-                    failed_questions += 1
-                    continue
-            
-            # Try to get response text safely
-            try:
-                raw_text = resp.text or ""
-            except ValueError:
+                    return _failed(a, f"Content blocked by safety filters: {candidate.finish_reason}", "safety_blocked"), True
+
+            if not parts:
                 # Response has no valid parts, use fallback
-                logger.warning(f"No valid response parts for question {a['question_id']}")
-                score = 0.5
-                rationale = "No valid response from AI (empty or blocked)"
-                per_q.append({
-                    "question_type": a["question_type"],
-                    "question_id": a["question_id"],
-                    "score": score,
-                    "rationale": rationale,
-                    "tags": ["no_response"]
-                })
-                total += score
-                failed_questions += 1
-                continue
-
-        # Robust JSON parsing with fallbacks
-        js = {}
-
-        # Try direct JSON parsing first
+                logger.warning("No valid response parts for question %s", a['question_id'])
+                return _failed(a, "No valid response from AI (empty or blocked)", "no_response"), True
+            raw_text = "".join(parts)
+
+        js = _decode_json(raw_text)
+        score, rationale, parsed = _parse_grade(js)
+        tags = [str(t) for t in js.get("tags") or []] if parsed else []
+
+        if parsed:
+            to_cache[cache_key] = {"score": score, "rationale": rationale, "tags": tags}
+
+        return _result(a, score, rationale, tags), False
+
+    async def grade_batch(batch: List[Tuple[Dict[str, Any], str]]) -> List[Tuple[Dict[str, Any], bool]]:
+        """Grade several answers in one request (rubric sent once); answers a decoded
+        response doesn't cover are re-graded one by one, an API error fails them all."""
+        items = "\n\n".join(
+            _BATCH_ITEM_TMPL.format_map({"n": i, "ident": _ident(a), "answer": a["answer_text"]})
+            for i, (a, _) in enumerate(batch, 1)
+        )
+        prompt = _BATCH_PROMPT_TMPL.format_map({"preamble": preamble, "items": items})
+
+        graded: Dict[str, Any] = {}
         try:
-            js = json.loads(raw_text)
-        except json.JSONDecodeError:
-            # Try to extract JSON from text that might contain extra content
-            import re
-            json_match = re.search(r'\{.*\}', raw_text, re.DOTALL)
-            if json_match:
-                try:
-                    js = json.loads(json_match.group())
-                except json.JSONDecodeError:
-                    pass
-
-        # Validate and extract score/rationale
-        score = 0.0
-        rationale = "Grading failed - unable to parse AI response"
-
-        if isinstance(js, dict):
-            # Try different possible keys for score
-            score_value = js.get("score") or js.get("grade") or js.get("rating")
-            if score_value is not None:
-                try:
-                    score = float(score_value)
-                    # Clamp to 0-1 range
-                    score = max(0.0, min(1.0, score))
-                except (ValueError, TypeError):
-                    pass
-
-            rationale_value = js.get("rationale") or js.get("explanation") or js.get("feedback") or js.get("comment")
-            if rationale_value:
-                rationale = str(rationale_value)[:500]  # Limit length
-
-        per_q.append({
-            "question_type": a["question_type"],
-            "question_id": a["question_id"],
-            "score": score,
-            "rationale": rationale,
-            "tags": []
-        })
-        total += score
+            async with sem:
+                resp = await _call_once(
+                    model, prompt,
+                    generation_config={
+                        "temperature": 0.2,
+                        "max_output_tokens": 200 * len(batch),
+                        "response_mime_type": "application/json",
+                        "response_schema": _BATCH_RESPONSE_SCHEMA
+                    }
+                )
+        except GoogleAPICallError as e:
+            # The API itself refused (429/503 already retried); per-question requests
+            # would only multiply the load, so the whole batch fails
+            logger.warning("Gemini API call failed for batch of %d questions: %s", len(batch), e)
+            return [(_failed(a, f"Grading failed due to API error: {str(e)[:100]}", "api_error"), True) for a, _ in batch]
+        except Exception as e:
+            logger.warning("Batch grading failed for %d questions, falling back to per-question: %s", len(batch), e)
+        else:
+            _record_usage(resp)
+            try:
+                items = orjson.loads(resp.text or "")
+            except ValueError as e:
+                # Blocked response (resp.text raises ValueError) or non-JSON output (JSONDecodeError)
+                logger.warning("Batch response unparseable for %d questions, falling back to per-question: %s", len(batch), e)
+            else:
+                if isinstance(items, list):
+                    graded = {str(js.get("question_id")): js for js in items if isinstance(js, dict)}
+
+        out: List[Tuple[Dict[str, Any], bool] | None] = []
+        retry: List[Tuple[int, Dict[str, Any], str]] = []
+        for a, cache_key in batch:
+            js = graded.get(_ident(a))
+            score, rationale, parsed = _parse_grade(js)
+            if parsed:
+                tags = [str(t) for t in js.get("tags") or []]
+                to_cache[cache_key] = {"score": score, "rationale": rationale, "tags": tags}
+                out.append((_result(a, score, rationale, tags), False))
+            else:
+                retry.append((len(out), a, cache_key))
+                out.append(None)
+
+        if retry:
+            singles = await asyncio.gather(*(grade_one(a, cache_key) for _, a, cache_key in retry))
+            for (idx, _, _), res in zip(retry, singles):
+                out[idx] = res
+        return out
+
+    # Blank and answer-keyed questions never reach the API
+    results: List[Tuple[Dict[str, Any], bool] | None] = [None] * len(answers)
+    pending: List[int] = []
+    for i, a in enumerate(answers):
+        local = _grade_locally(a, rubric or {})
+        if local is not None:
+            results[i] = (local, False)
+        else:
+            pending.append(i)
+
+    # Serve what we can from the response cache
+    cache_keys = {
+        i: llm_cache.make_key(GEMINI_MODEL, rubric_json, answers[i]["question_type"], answers[i]["question_id"], answers[i]["answer_text"])
+        for i in pending
+    }
+    cached = await asyncio.to_thread(llm_cache.get_many, list(cache_keys.values()))
+
+    misses: List[int] = []
+    for i in pending:
+        hit = cached.get(cache_keys[i])
+        if hit:
+            results[i] = (_result(answers[i], hit["score"], hit["rationale"], hit.get("tags")), False)
+        else:
+            misses.append(i)
+
+    # Grade the rest in batches of GEMINI_BATCH_SIZE; batches run concurrently and
+    # gather preserves order, so results map back by index
+    batches = [misses[j:j + GEMINI_BATCH_SIZE] for j in range(0, len(misses), GEMINI_BATCH_SIZE)]
+    batch_results = await asyncio.gather(
+        *(grade_batch([(answers[i], cache_keys[i]) for i in b]) for b in batches),
+        return_exceptions=True
+    )
+    for b, res in zip(batches, batch_results):
+        if isinstance(res, BaseException):
+            logger.warning("Grading task failed for %d questions: %s", len(b), res)
+            res = [(_failed(answers[i], f"Grading failed due to API error: {str(res)[:100]}", "api_error"), True) for i in b]
+        for i, r in zip(b, res):
+            results[i] = r
+
+    await asyncio.to_thread(llm_cache.set_many, to_cache)
+
+    per_q: List[Dict[str, Any]] = []
+    total = 0.0
+    failed_questions = 0
+
+    for result, failed in results:
+        if failed:
+            failed_questions += 1
+        per_q.append(result)
+        total += result["score"]
+
+    total_input_tokens = usage_totals["input_tokens"]
+    cached_input_tokens = usage_totals["cached_input_tokens"]
+    total_output_tokens = usage_totals["output_tokens"]
 
     # Log summary of grading results
     success_rate = (len(answers) - failed_questions) / max(1, len(answers))
     if failed_questions > 0:
-        logger.warning(f"Grading completed with {failed_questions} failures out of {len(answers)} questions ({success_rate:.1%} success rate)")
+        logger.warning("Grading completed with %d failures out of %d questions (%.1f%% success rate)", failed_questions, len(answers), success_rate * 100)
 
     overall_score = total / max(1, len(answers))
     grading_notes = "Gemini auto‑grade"
@@ -187,30 +540,37 @@ Return a JSON object with:
         "notes": grading_notes
     }
 
-    # Calculate approximate cost (Gemini 2.0 Flash pricing: $0.15/1M input tokens, $0.60/1M output tokens)
-    input_cost = (total_input_tokens / 1_000_000) * 0.15
-    output_cost = (total_output_tokens / 1_000_000) * 0.60
+    # Calculate approximate cost from the SDK-reported usage (no separate countTokens calls)
+    input_cost = ((total_input_tokens - cached_input_tokens) / 1_000_000) * GEMINI_INPUT_PRICE_PER_M
+    input_cost += (cached_input_tokens / 1_000_000) * GEMINI_CACHED_INPUT_PRICE_PER_M
+    output_cost = (total_output_tokens / 1_000_000) * GEMINI_OUTPUT_PRICE_PER_M
     total_cost_usd = input_cost + output_cost
 
     cost = {
         "input_tokens": total_input_tokens,
+        "cached_input_tokens": cached_input_tokens,
         "output_tokens": total_output_tokens,
         "usd": round(total_cost_usd, 6)
     }
+
+    if trace is not None:
+        span = trace.get_current_span()
+        span.set_attribute("gen_ai.request.model", GEMINI_MODEL)
+        span.set_attribute("gen_ai.usage.input_tokens", total_input_tokens)
+        span.set_attribute("gen_ai.usage.output_tokens", total_output_tokens)
+
     return per_q, overall, cost
 
 
 def _fallback_grade(answers: List[Dict[str, Any]], rubric: Dict[str, Any], error_reason: str) -> Tuple[List[Dict[str, Any]], Dict[str, Any], Dict[str, float]]:
     """Fallback grading when Gemini API is completely unavailable"""
-    import logging
-    logger = logging.getLogger(__name__)
 
-    logger.error(f"Using fallback grading due to: {error_reason}")
+    logger.error("Using fallback grading due to: %s", error_reason)
 
     # Use dummy grading as fallback
     return _dummy_grade(answers, rubric)
 
-def grade(answers: List[Dict[str, Any]], rubric: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], Dict[str, Any], Dict[str, float]]:
+async def grade(answers: List[Dict[str, Any]], rubric: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], Dict[str, Any], Dict[str, float]]:
     if GRADER_MODE == "gemini":
-        return _gemini_grade(answers, rubric or {})
+        return await _gemini_grade(answers, rubric or {})
     return _dummy_grade(answers, rubric or {})
@@ -0,0 +1,102 @@
+# Content-addressed cache for parsed Gemini grading responses.
+# Keys are sha256 digests of everything that determines the model output
+# (model, rubric, question identity, answer text), values are the parsed
+# {"score", "rationale", "tags"} dicts, so retries and re-grades skip the LLM call.
+# get_many/set_many batch a whole grading run into one round trip each.
+#
+# Backend: Redis when REDIS_URL is set, otherwise the Supabase table
+# `llm_cache` (see supabase/migrations). Entries expire after
+# LLM_CACHE_TTL_SECONDS (0 disables the cache): Redis drops them itself, the
+# Supabase table is purged of expired rows from set_many at most hourly per
+# process. Backend errors are logged and treated as misses so grading never
+# depends on the cache being up.
+
+from typing import Any, Dict, List, Optional
+import os, json, hashlib, logging, time
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL")
+LLM_CACHE_TABLE = os.getenv("LLM_CACHE_TABLE", "llm_cache")
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+if LLM_CACHE_TTL_SECONDS <= 0:
+    BACKEND = None
+elif REDIS_URL:
+    BACKEND = "redis"
+elif os.getenv("SUPABASE_URL"):
+    BACKEND = "supabase"
+else:
+    BACKEND = None  # 'redis' | 'supabase' | None (disabled)
+
+_redis = None
+
+_PURGE_INTERVAL = 3600  # seconds between deletes of expired Supabase rows
+_last_purge: Optional[float] = None  # monotonic time of the last purge
+
+def _redis_client():
+    global _redis
+    if _redis is None:
+        import redis  # optional dependency, only needed when REDIS_URL is set
+        _redis = redis.Redis.from_url(REDIS_URL)
+    return _redis
+
+def make_key(*parts: Any) -> str:
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(str(p).encode())
+        h.update(b"\x1f")  # unit separator keeps ("ab", "c") != ("a", "bc")
+    return h.hexdigest()
+
+def _cutoff() -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - LLM_CACHE_TTL_SECONDS))
+
+def get_many(keys: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Look up several keys in one round trip (Redis MGET / one PostgREST query);
+    returns the hits only."""
+    if BACKEND is None or not keys:
+        return {}
+    try:
+        if BACKEND == "redis":
+            raws = _redis_client().mget([f"{LLM_CACHE_TABLE}:{k}" for k in keys])
+            return {k: json.loads(raw) for k, raw in zip(keys, raws) if raw}
+
+        from app.supa import sb
+        res = sb().table(LLM_CACHE_TABLE).select("key, value").in_("key", list(keys)).gte("created_at", _cutoff()).execute()
+        return {r["key"]: r["value"] for r in res.data or []}
+    except Exception as e:
+        logger.warning("LLM cache lookup failed (%s): %s", BACKEND, e)
+        return {}
+
+def set_many(entries: Dict[str, Dict[str, Any]]) -> None:
+    """Store several entries in one round trip (Redis pipeline / one bulk upsert)."""
+    global _last_purge
+    if BACKEND is None or not entries:
+        return
+    try:
+        if BACKEND == "redis":
+            pipe = _redis_client().pipeline(transaction=False)
+            for k, v in entries.items():
+                pipe.set(f"{LLM_CACHE_TABLE}:{k}", json.dumps(v), ex=LLM_CACHE_TTL_SECONDS)
+            pipe.execute()
+            return
+
+        from app.supa import sb, utc_now
+        created_at = utc_now()
+        sb().table(LLM_CACHE_TABLE).upsert([
+            {"key": k, "value": v, "created_at": created_at} for k, v in entries.items()
+        ]).execute()
+
+        # Lookups already ignore expired rows; deleting them keeps the table bounded
+        now = time.monotonic()
+        if _last_purge is None or now - _last_purge >= _PURGE_INTERVAL:
+            _last_purge = now
+            sb().table(LLM_CACHE_TABLE).delete().lt("created_at", _cutoff()).execute()
+    except Exception as e:
+        logger.warning("LLM cache store failed (%s): %s", BACKEND, e)
+
+def get(key: str) -> Optional[Dict[str, Any]]:
+    return get_many([key]).get(key)
+
+def set(key: str, value: Dict[str, Any]) -> None:
+    set_many({key: value})
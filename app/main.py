@@ -1,15 +1,23 @@
+import asyncio
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import anyio.to_thread
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
+from app import pdf_pool
 from app.submit import router as submit_router
-from app.worker import router as worker_router
+from app.worker import router as worker_router, aclose_http
 
-# Configure logging
+# Configure logging (once: --reload re-imports this module)
 log_level = os.getenv("LOG_LEVEL", "INFO").upper()
-logging.basicConfig(
-    level=getattr(logging, log_level, logging.INFO),
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
+if not logging.getLogger().handlers:
+    logging.basicConfig(
+        level=getattr(logging, log_level, logging.INFO),
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
 
 logger = logging.getLogger(__name__)
 
@@ -32,16 +40,28 @@ def validate_environment():
             missing.append(var)
 
     if missing:
-        error_msg = f"Missing required environment variables: {', '.join(missing)}"
-        logger.error(error_msg)
-        raise RuntimeError(error_msg)
+        logger.error("Missing required environment variables: %s", ", ".join(missing))
+        raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
 
     logger.info("Environment validation passed")
 
 # Validate environment on startup
 validate_environment()
 
-app = FastAPI(title="Cloudhire AI API")
+# Threads available for blocking work (sync SDK calls, PDF rendering when PDF_WORKERS=0)
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # asyncio.to_thread uses the loop's default executor; sync endpoints use anyio's limiter
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=THREADPOOL_SIZE))
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    pdf_pool.start()
+    yield
+    await aclose_http()
+    pdf_pool.shutdown()
+
+app = FastAPI(title="Cloudhire AI API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 @app.get("/health")
 def health():
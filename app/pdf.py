@@ -1,25 +1,36 @@
 from jinja2 import Environment, FileSystemLoader, select_autoescape
-from weasyprint import HTML
+from weasyprint import HTML, CSS
 from datetime import datetime
-import io, os
+from typing import BinaryIO
+import os
 
+_TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), "templates")
+
+# Templates ship with the image, so skip Jinja's per-render mtime check
 _env = Environment(
-    loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), "templates")),
-    autoescape=select_autoescape()
+    loader=FileSystemLoader(_TEMPLATES_DIR),
+    autoescape=select_autoescape(),
+    auto_reload=False
 )
 
-def render_report_pdf(attempt_id: str, results, overall) -> bytes:
-    # Group by section label (None sections go last)
-    sorted_results = sorted(
-        results,
-        key=lambda r: (str(r.get("section") or "ZZZ"), str(r["question_type"]), int(r["question_id"]))
-    )
-    html = _env.get_template("report.html").render(
+# Parsed once at import and reused for every report
+_TEMPLATE = _env.get_template("report.html")
+_CSS = CSS(filename=os.path.join(_TEMPLATES_DIR, "report.css"))
+
+def render_report_pdf(attempt_id: str, results, overall, fileobj: BinaryIO) -> None:
+    """Render the report, streaming the PDF into fileobj."""
+    # Group by section label (None sections go last); keys are built once per
+    # result and the tuples sorted directly (decorate-sort-undecorate)
+    keyed = [
+        (str(r.get("section") or "ZZZ"), str(r["question_type"]), int(r["question_id"]), i, r)
+        for i, r in enumerate(results)
+    ]
+    keyed.sort()
+    sorted_results = [k[-1] for k in keyed]
+    html = _TEMPLATE.render(
         attempt_id=attempt_id,
         results=sorted_results,
         overall=overall,
         generated_at=datetime.utcnow().isoformat()
     )
-    buf = io.BytesIO()
-    HTML(string=html).write_pdf(buf)
-    return buf.getvalue()
+    HTML(string=html).write_pdf(target=fileobj, stylesheets=[_CSS])
@@ -0,0 +1,68 @@
+# Pre-started processes for report rendering.
+# Each worker imports WeasyPrint and renders a throwaway report at startup, so
+# font discovery and template/CSS parsing are paid once per worker rather than
+# by the first job, and layout runs outside the API process's GIL.
+# PDF_WORKERS=0 renders on a thread in-process instead.
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio, io, logging, multiprocessing, os
+
+logger = logging.getLogger(__name__)
+
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "2"))
+
+_POOL: ProcessPoolExecutor | None = None
+
+def _warm_weasyprint() -> None:
+    try:
+        from app.pdf import render_report_pdf
+        render_report_pdf("warmup", [], {"score": 0.0, "band": "", "notes": ""}, io.BytesIO())
+    except Exception as e:
+        # An initializer that raises breaks the whole pool; real renders still report errors
+        logger.warning("PDF worker warm-up failed: %s", e)
+
+def _render_to_path(attempt_id: str, results, overall, path: str) -> None:
+    # Runs in a pool process: file objects don't cross process boundaries, paths do
+    from app.pdf import render_report_pdf
+    with open(path, "wb") as f:
+        render_report_pdf(attempt_id, results, overall, f)
+
+def start() -> None:
+    """Boot (and warm) the pool; called from the app lifespan."""
+    global _POOL
+    if _POOL is None and PDF_WORKERS > 0:
+        # spawn, not fork: the parent runs an event loop and thread pools
+        _POOL = ProcessPoolExecutor(
+            max_workers=PDF_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warm_weasyprint
+        )
+        # Workers spawn on demand; one no-op per slot boots them all now
+        for _ in range(PDF_WORKERS):
+            _POOL.submit(int)
+
+def shutdown() -> None:
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown(wait=False, cancel_futures=True)
+        _POOL = None
+
+async def render_report_pdf_to(attempt_id: str, results, overall, path: str) -> None:
+    """Render the report into the file at path."""
+    if PDF_WORKERS <= 0:
+        return await asyncio.to_thread(_render_to_path, attempt_id, results, overall, path)
+    loop = asyncio.get_running_loop()
+    start()
+    pool = _POOL
+    try:
+        return await loop.run_in_executor(pool, _render_to_path, attempt_id, results, overall, path)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed mid-layout), which poisons the executor
+        # for every later submit; replace it (once, if concurrent renders all saw
+        # it break) and retry this report once
+        logger.warning("PDF worker pool broken; restarting it for attempt %s", attempt_id)
+        if _POOL is pool:
+            shutdown()
+        start()
+        return await loop.run_in_executor(_POOL, _render_to_path, attempt_id, results, overall, path)
@@ -3,12 +3,11 @@
 # - Enqueues Cloud Task with OIDC to hit /internal/tasks/grade
 
 from __future__ import annotations
-import os, json, uuid
+import asyncio, os, uuid
 from fastapi import APIRouter, Request, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from google.cloud import tasks_v2
 from google.api_core.exceptions import GoogleAPICallError, PermissionDenied, NotFound
-from urllib.parse import urlparse
 
 router = APIRouter()
 
@@ -29,12 +28,26 @@ REQUIRED_ENVS = {
     "TASKS_SERVICE_ACCOUNT_EMAIL": TASKS_SA,
 }
 
+# One Cloud Tasks client (and gRPC channel) per process, created on first use
+_tasks_client: tasks_v2.CloudTasksClient | None = None
+
+# queue_path is a static formatter, so the queue resource name is a module constant
+_PARENT = tasks_v2.CloudTasksClient.queue_path(PROJECT or "", LOCATION or "", QUEUE)
+
+def _tasks() -> tasks_v2.CloudTasksClient:
+    global _tasks_client
+    if _tasks_client is None:
+        _tasks_client = tasks_v2.CloudTasksClient()
+    return _tasks_client
+
 def _require_envs() -> None:
     missing = [k for k,v in REQUIRED_ENVS.items() if not v]
     if missing:
         raise HTTPException(status_code=500, detail=f"Missing env vars: {', '.join(missing)}")
 
 class SubmitPayload(BaseModel):
+    model_config = ConfigDict(extra="ignore", str_strip_whitespace=False)
+
     attempt_id: str                # UUID from Rails at submit time
     user_id: str                   # public.user_info.id
     exam_id: str | None = None     # optional label if you want it
@@ -45,6 +58,10 @@ class SubmitPayload(BaseModel):
     callback: dict | None = None     # { "url": "https://rails/..." }
     metadata: dict | None = None
 
+class TaskBody(SubmitPayload):
+    """Cloud Tasks body: the validated submit payload plus the generated job id."""
+    job_id: str
+
 @router.post("/v1/grade_jobs/submit")
 async def submit(req: Request, payload: SubmitPayload):
     # App bearer check
@@ -56,26 +73,22 @@ async def submit(req: Request, payload: SubmitPayload):
     # Generate a job id now (idempotency is enforced in DB by attempt_id+purpose)
     job_id = str(uuid.uuid4())
 
-    body = payload.model_dump()
-    body["job_id"] = job_id
+    # Already validated, so construct without re-validating and let pydantic-core write the JSON
+    body = TaskBody.model_construct(**dict(payload), job_id=job_id).model_dump_json().encode()
 
     try:
-        client = tasks_v2.CloudTasksClient()
-        parent = client.queue_path(PROJECT, LOCATION, QUEUE)
-        
-        # Extract base URL for OIDC audience  
-        parsed_url = urlparse(WORKER_URL)
-        audience = f"{parsed_url.scheme}://{parsed_url.netloc}"
+        client = _tasks()
 
         task = {
             "http_request": {
                 "http_method": tasks_v2.HttpMethod.POST,
                 "url": WORKER_URL,  # Full URL for invocation
                 "headers": {"Content-Type": "application/json"},
-                "body": json.dumps(body).encode(),
+                "body": body,
             }
         }
-        client.create_task(parent=parent, task=task)
+        # Sync gRPC client: run the RPC on a worker thread so the event loop keeps serving
+        await asyncio.to_thread(client.create_task, parent=_PARENT, task=task)
     
     except NotFound as e:
         raise HTTPException(status_code=500, detail=f"Queue not found: {PROJECT}/{LOCATION}/{QUEUE}") from e
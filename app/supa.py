@@ -1,4 +1,4 @@
-import os, hashlib, time
+import os, time, threading
 from typing import Any, Dict, List
 from supabase import create_client, Client
 from fastapi import HTTPException
@@ -7,8 +7,28 @@ SUPABASE_URL = os.environ["SUPABASE_URL"]
 SUPABASE_SERVICE_KEY = os.environ["SUPABASE_SERVICE_KEY"]
 REPORTS_BUCKET = os.environ.get("STORAGE_BUCKET", "reports")
 
+# One client per process: its PostgREST and Storage httpx sessions keep
+# connections (and TLS) alive across helpers and jobs
+_CLIENT: Client | None = None
+_CLIENT_LOCK = threading.Lock()  # helpers also run on worker threads
+
 def sb() -> Client:
-    return create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+    global _CLIENT
+    if _CLIENT is None:
+        with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+    return _CLIENT
+
+_TS_CACHE = (0, "")  # (epoch second, formatted)
+
+def utc_now() -> str:
+    """Current UTC time as ISO 8601 (second precision), formatted at most once per second."""
+    global _TS_CACHE
+    now = int(time.time())
+    if _TS_CACHE[0] != now:
+        _TS_CACHE = (now, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now)))
+    return _TS_CACHE[1]
 
 # --- grading tables helpers ---
 
@@ -31,7 +51,7 @@ def upsert_job(job_id: str, attempt_id: str, user_id: str, purpose: str, trigger
             # Job exists but no results yet, just update status and use existing job_id
             client.table("grade_jobs").update({
                 "status": "processing",
-                "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "started_at": utc_now(),
             }).eq("id", existing_job_id).execute()
             # Update the job_id reference to match existing
             return existing_job_id
@@ -44,7 +64,7 @@ def upsert_job(job_id: str, attempt_id: str, user_id: str, purpose: str, trigger
             "purpose": purpose,
             "status": "processing",
             "triggered_by": triggered_by,
-            "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "started_at": utc_now(),
         }).execute()
         return job_id
 
@@ -52,25 +72,27 @@ def set_job_status(job_id: str, status: str, **fields) -> None:
     client = sb()
     client.table("grade_jobs").update({"status": status, **fields}).eq("id", job_id).execute()
 
+def set_webhook_status(job_id: str, status: str) -> None:
+    """Record webhook delivery ('delivered' | 'failed') without touching the job status."""
+    client = sb()
+    client.table("grade_jobs").update({
+        "webhook_status": status,
+        "webhook_at": utc_now(),
+    }).eq("id", job_id).execute()
+
 def fetch_answers_for_user(user_id: str) -> List[Dict[str, Any]]:
     """
     Read the latest answer per (question_type, question_id) from public.user_responses.
+    Dedup happens in Postgres (latest_answers: DISTINCT ON ... ORDER BY created_at DESC),
+    so only one row per question comes over the wire.
     """
     client = sb()
-    res = client.table("user_responses").select(
-        "question_type,question_id,response_text,response_numerical,response_units,created_at"
-    ).eq("user_id", user_id).order("created_at", desc=True).execute()
+    res = client.rpc("latest_answers", {"uid": user_id}).execute()
 
     rows = res.data or []
-    seen = set()
     out: List[Dict[str, Any]] = []
 
     for r in rows:
-        key = (r["question_type"], r["question_id"])
-        if key in seen:
-            continue
-        seen.add(key)
-
         if r["response_text"]:
             txt = r["response_text"]
         elif r["response_numerical"] is not None:
@@ -86,33 +108,48 @@ def fetch_answers_for_user(user_id: str) -> List[Dict[str, Any]]:
         })
     return out
 
-def insert_results(job_id: str, per_q: List[Dict[str, Any]], overall: Dict[str, Any]) -> None:
+def _result_rows(per_q: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [
+        {
+            "section": r.get("section"),
+            "question_type": r["question_type"],
+            "question_id": r["question_id"],
+            "score": r["score"],
+            "rationale": r.get("rationale"),
+            "tags": r.get("tags"),
+        } for r in per_q
+    ]
+
+def finalize_job(job_id: str, per_q: List[Dict[str, Any]], overall: Dict[str, Any], cost: Dict[str, Any]) -> None:
+    """Insert results and overall and mark the job completed with its cost, in one
+    RPC (single transaction): finalize_grade_job wraps insert_grade_bundle and
+    the grade_jobs status/cost update."""
     client = sb()
-    if per_q:
-        client.table("grade_results").insert([
-            {
-                "job_id": job_id,
-                "section": r.get("section"),
-                "question_type": r["question_type"],
-                "question_id": r["question_id"],
-                "score": r["score"],
-                "rationale": r.get("rationale"),
-                "tags": r.get("tags"),
-            } for r in per_q
-        ]).execute()
-    client.table("grade_overall").insert({"job_id": job_id, **overall}).execute()
-
-def upload_pdf(job_id: str, pdf_bytes: bytes) -> str:
+    client.rpc("finalize_grade_job", {
+        "job_id": job_id,
+        "per_q": _result_rows(per_q),
+        "overall": overall,
+        "costs": {
+            "input_tokens": cost.get("input_tokens", 0),
+            "output_tokens": cost.get("output_tokens", 0),
+            "usd": cost.get("usd", 0.0),
+        },
+    }).execute()
+
+def upload_pdf(job_id: str, pdf_file: str) -> str:
+    """Upload the report from the file at pdf_file, streamed from disk rather than
+    held in memory."""
     client = sb()
     path = f"{time.strftime('%Y/%m')}/{job_id}.pdf"
-    client.storage.from_(REPORTS_BUCKET).upload(path, pdf_bytes, {
-        "content-type": "application/pdf",
-        "upsert": "true"
-    })
+    with open(pdf_file, "rb") as fh:
+        client.storage.from_(REPORTS_BUCKET).upload(path, fh, {
+            "content-type": "application/pdf",
+            "upsert": "true"
+        })
     # TODO: Create artifacts table in Supabase
-    # sha = hashlib.sha256(pdf_bytes).hexdigest()
+    # sha = hashlib.sha256(open(pdf_file, "rb").read()).hexdigest()
     # client.table("artifacts").insert({
     #     "job_id": job_id, "kind": "pdf", "storage_path": path,
-    #     "size_bytes": len(pdf_bytes), "sha256": sha
+    #     "size_bytes": os.path.getsize(pdf_file), "sha256": sha
     # }).execute()
     return path
@@ -0,0 +1,9 @@
+-- Response cache for Gemini grading calls (see app/llm_cache.py).
+-- Only used when REDIS_URL is not set.
+create table if not exists public.llm_cache (
+  key        text primary key,
+  value      jsonb not null,
+  created_at timestamptz not null default now()
+);
+
+create index if not exists llm_cache_created_at_idx on public.llm_cache (created_at);
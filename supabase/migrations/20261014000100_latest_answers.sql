@@ -0,0 +1,15 @@
+-- Latest answer per (question_type, question_id) for a user
+-- (see fetch_answers_for_user in app/supa.py).
+create or replace function public.latest_answers(uid public.user_responses.user_id%type)
+returns setof public.user_responses
+language sql
+stable
+as $$
+  select distinct on (r.question_type, r.question_id) r.*
+  from public.user_responses r
+  where r.user_id = uid
+  order by r.question_type, r.question_id, r.created_at desc
+$$;
+
+create index if not exists user_responses_latest_idx
+  on public.user_responses (user_id, question_type, question_id, created_at desc);
@@ -0,0 +1,16 @@
+-- Per-question results and the overall row for a job in one round trip / transaction
+-- (called by finalize_grade_job; see finalize_job in app/supa.py).
+create or replace function public.insert_grade_bundle(job_id uuid, per_q jsonb, overall jsonb)
+returns void
+language plpgsql
+as $$
+begin
+  insert into public.grade_results (job_id, section, question_type, question_id, score, rationale, tags)
+  select insert_grade_bundle.job_id, r.section, r.question_type, r.question_id, r.score, r.rationale, r.tags
+  from jsonb_populate_recordset(null::public.grade_results, coalesce(per_q, '[]'::jsonb)) r;
+
+  insert into public.grade_overall (job_id, score, band, notes)
+  select insert_grade_bundle.job_id, o.score, o.band, o.notes
+  from jsonb_populate_record(null::public.grade_overall, overall) o;
+end;
+$$;
@@ -0,0 +1,18 @@
+-- Results, overall and the job's completed status/cost in one round trip / transaction
+-- (see finalize_job in app/supa.py).
+create or replace function public.finalize_grade_job(job_id uuid, per_q jsonb, overall jsonb, costs jsonb)
+returns void
+language plpgsql
+as $$
+begin
+  perform public.insert_grade_bundle(finalize_grade_job.job_id, per_q, overall);
+
+  update public.grade_jobs
+  set status = 'completed',
+      finished_at = now(),
+      cost_input_tokens = coalesce((costs->>'input_tokens')::integer, 0),
+      cost_output_tokens = coalesce((costs->>'output_tokens')::integer, 0),
+      cost_usd = coalesce((costs->>'usd')::numeric, 0)
+  where id = finalize_grade_job.job_id;
+end;
+$$;
@@ -0,0 +1,5 @@
+-- Webhook delivery is tracked apart from the job status, so a failed delivery
+-- doesn't mark a graded job failed (see set_webhook_status in app/supa.py).
+alter table public.grade_jobs
+  add column if not exists webhook_status text check (webhook_status in ('delivered', 'failed')),
+  add column if not exists webhook_at timestamptz;
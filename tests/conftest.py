@@ -1,5 +1,5 @@
 import pytest
-import os
+import json
 from unittest.mock import MagicMock
 
 @pytest.fixture
@@ -51,33 +51,44 @@ def mock_gemini_response():
     usage_mock = MagicMock()
     usage_mock.prompt_token_count = 150
     usage_mock.candidates_token_count = 50
+    usage_mock.cached_content_token_count = 0
+    mock_response.usage_metadata = usage_mock
+
+    # Streaming calls (stream=True) iterate the response as a single chunk
+    mock_response.__aiter__.return_value = [mock_response]
+
+    return mock_response
+
+@pytest.fixture
+def mock_gemini_batch_response(sample_answers):
+    """Mock Gemini API response for a batched grading request"""
+    mock_response = MagicMock()
+    mock_response.text = json.dumps([
+        {
+            "question_id": f"{a['question_type']}:{a['question_id']}",
+            "score": 0.85,
+            "rationale": "Good answer with solid reasoning"
+        } for a in sample_answers
+    ])
+
+    usage_mock = MagicMock()
+    usage_mock.prompt_token_count = 150
+    usage_mock.candidates_token_count = 50
+    usage_mock.cached_content_token_count = 0
     mock_response.usage_metadata = usage_mock
 
     return mock_response
 
 @pytest.fixture(autouse=True)
-def mock_env_vars():
-    """Set up test environment variables"""
+def mock_env_vars(monkeypatch):
+    """Set up test environment variables (restored by monkeypatch)"""
     test_env = {
         "GEMINI_API_KEY": "test-key",
         "GRADER_MODE": "dummy",  # Use dummy mode for tests by default
-        "GEMINI_MODEL": "gemini-2.0-flash"
+        "GEMINI_MODEL": "gemini-2.0-flash",
+        # app.supa reads these at import; the client itself is created lazily
+        "SUPABASE_URL": "http://localhost:54321",
+        "SUPABASE_SERVICE_KEY": "test-service-key"
     }
-
-    # Save original values
-    originals = {}
-    for key in test_env:
-        originals[key] = os.environ.get(key)
-
-    # Set test values
     for key, value in test_env.items():
-        os.environ[key] = value
-
-    yield
-
-    # Restore originals
-    for key, value in originals.items():
-        if value is None:
-            os.environ.pop(key, None)
-        else:
-            os.environ[key] = value
+        monkeypatch.setenv(key, value)
@@ -0,0 +1,104 @@
+from unittest.mock import patch, MagicMock
+import app.llm_cache as llm_cache
+
+
+class TestCacheKey:
+    """Test content-addressed cache keys"""
+
+    def test_key_is_deterministic(self):
+        """Same inputs produce the same sha256 key"""
+        k1 = llm_cache.make_key("gemini-2.0-flash", "{}", "essay", 102, "answer")
+        k2 = llm_cache.make_key("gemini-2.0-flash", "{}", "essay", 102, "answer")
+        assert k1 == k2
+        assert len(k1) == 64
+
+    def test_key_changes_with_any_part(self):
+        """Changing model, rubric or answer changes the key"""
+        base = llm_cache.make_key("m", "{}", "essay", 102, "answer")
+        assert llm_cache.make_key("m2", "{}", "essay", 102, "answer") != base
+        assert llm_cache.make_key("m", '{"a":1}', "essay", 102, "answer") != base
+        assert llm_cache.make_key("m", "{}", "essay", 102, "answer!") != base
+
+    def test_key_parts_are_delimited(self):
+        """Concatenation boundaries are part of the key"""
+        assert llm_cache.make_key("ab", "c") != llm_cache.make_key("a", "bc")
+
+
+class TestCacheBackend:
+    """Test backend selection and graceful degradation"""
+
+    def test_disabled_backend_is_a_miss(self):
+        """No backend configured: get misses and set is a no-op"""
+        with patch.object(llm_cache, "BACKEND", None):
+            llm_cache.set("k", {"score": 1.0, "rationale": "x"})
+            assert llm_cache.get("k") is None
+
+    def test_redis_roundtrip(self):
+        """Values are JSON-encoded into Redis with the configured TTL"""
+        store = {}
+        fake = MagicMock()
+        pipe = fake.pipeline.return_value
+        pipe.set.side_effect = lambda k, v, ex=None: store.__setitem__(k, v)
+        fake.mget.side_effect = lambda ks: [store.get(k) for k in ks]
+
+        with patch.object(llm_cache, "BACKEND", "redis"), patch.object(llm_cache, "_redis", fake):
+            llm_cache.set("k", {"score": 0.9, "rationale": "Good"})
+            assert llm_cache.get("k") == {"score": 0.9, "rationale": "Good"}
+            assert pipe.set.call_args.kwargs["ex"] == llm_cache.LLM_CACHE_TTL_SECONDS
+
+    def test_redis_batches_round_trips(self):
+        """get_many is one MGET and set_many one pipeline, whatever the key count"""
+        fake = MagicMock()
+        fake.mget.return_value = [b'{"score": 0.0, "rationale": "Wrong"}', None]
+
+        with patch.object(llm_cache, "BACKEND", "redis"), patch.object(llm_cache, "_redis", fake):
+            assert llm_cache.get_many(["a", "b"]) == {"a": {"score": 0.0, "rationale": "Wrong"}}
+            llm_cache.set_many({"a": {"score": 1.0}, "b": {"score": 0.5}})
+
+        fake.mget.assert_called_once()
+        pipe = fake.pipeline.return_value
+        assert pipe.set.call_count == 2
+        pipe.execute.assert_called_once()
+
+    def test_supabase_batches_round_trips(self):
+        """Supabase lookups use one in_() query and writes one bulk upsert"""
+        client = MagicMock()
+        table = client.table.return_value
+        table.select.return_value.in_.return_value.gte.return_value.execute.return_value.data = [
+            {"key": "a", "value": {"score": 0.9, "rationale": "Good"}}
+        ]
+
+        with patch.object(llm_cache, "BACKEND", "supabase"), \
+             patch.dict("sys.modules", {"app.supa": MagicMock(sb=lambda: client, utc_now=lambda: "2026-10-14T00:00:00Z")}):
+            assert llm_cache.get_many(["a", "b"]) == {"a": {"score": 0.9, "rationale": "Good"}}
+            llm_cache.set_many({"a": {"score": 1.0}, "b": {"score": 0.5}})
+
+        assert table.select.return_value.in_.call_args.args == ("key", ["a", "b"])
+        rows = table.upsert.call_args.args[0]
+        assert [r["key"] for r in rows] == ["a", "b"]
+
+    def test_backend_errors_fall_through(self):
+        """Backend failures are logged and treated as cache misses"""
+        fake = MagicMock()
+        fake.mget.side_effect = ConnectionError("redis down")
+        fake.pipeline.return_value.execute.side_effect = ConnectionError("redis down")
+
+        with patch.object(llm_cache, "BACKEND", "redis"), patch.object(llm_cache, "_redis", fake), \
+             patch.object(llm_cache.logger, "warning") as warn:
+            llm_cache.set_many({"k": {"score": 0.9, "rationale": "Good"}})
+            assert llm_cache.get_many(["k"]) == {}
+
+        assert warn.call_count == 2
+
+    def test_supabase_purges_expired_rows(self):
+        """Writes delete expired rows, at most once per purge interval"""
+        client = MagicMock()
+        table = client.table.return_value
+
+        with patch.object(llm_cache, "BACKEND", "supabase"), patch.object(llm_cache, "_last_purge", None), \
+             patch.dict("sys.modules", {"app.supa": MagicMock(sb=lambda: client, utc_now=lambda: "2026-10-14T00:00:00Z")}):
+            llm_cache.set_many({"a": {"score": 1.0}})
+            llm_cache.set_many({"b": {"score": 0.5}})
+
+        table.delete.assert_called_once()
+        assert table.delete.return_value.lt.call_args.args[0] == "created_at"
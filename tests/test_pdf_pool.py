@@ -0,0 +1,45 @@
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import app.pdf_pool as pdf_pool
+
+
+@pytest.fixture(autouse=True)
+def fake_pool():
+    """Replace the process pool with mocks; no render processes are spawned"""
+    with patch.object(pdf_pool, "PDF_WORKERS", 2), \
+         patch.object(pdf_pool, "ProcessPoolExecutor", side_effect=lambda **kw: MagicMock()) as executor:
+        pdf_pool._POOL = None
+        yield executor
+        pdf_pool._POOL = None
+
+
+class TestPdfPool:
+    """Test recovery from a dead render process"""
+
+    @pytest.mark.asyncio
+    async def test_broken_pool_is_replaced_and_retried(self, fake_pool):
+        """Test BrokenProcessPool restarts the pool and retries the render once"""
+        loop = MagicMock()
+        loop.run_in_executor = AsyncMock(side_effect=[BrokenProcessPool("worker died"), None])
+
+        with patch.object(pdf_pool.asyncio, "get_running_loop", return_value=loop):
+            await pdf_pool.render_report_pdf_to("a1", [], {}, "/tmp/r.pdf")
+
+        assert fake_pool.call_count == 2  # original pool + replacement
+        first, second = (c.args[0] for c in loop.run_in_executor.call_args_list)
+        assert first is not second and second is pdf_pool._POOL
+        first.shutdown.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_second_failure_propagates(self, fake_pool):
+        """Test the render is retried only once"""
+        loop = MagicMock()
+        loop.run_in_executor = AsyncMock(side_effect=BrokenProcessPool("worker died"))
+
+        with patch.object(pdf_pool.asyncio, "get_running_loop", return_value=loop):
+            with pytest.raises(BrokenProcessPool):
+                await pdf_pool.render_report_pdf_to("a1", [], {}, "/tmp/r.pdf")
+
+        assert loop.run_in_executor.await_count == 2
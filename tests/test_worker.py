@@ -0,0 +1,141 @@
+import hmac
+import hashlib
+import pytest
+import httpx
+from unittest.mock import patch, AsyncMock
+from tenacity import wait_none
+
+
+@pytest.fixture
+def worker(mock_env_vars):
+    """app.worker, imported once the Supabase env vars it needs are set"""
+    import app.worker
+    return app.worker
+
+
+@pytest.fixture(autouse=True)
+def no_webhook_backoff(worker):
+    """Retry webhooks without sleeping"""
+    original = worker._post_webhook.retry.wait
+    worker._post_webhook.retry.wait = wait_none()
+    yield
+    worker._post_webhook.retry.wait = original
+
+
+class TestWebhookDelivery:
+    """Test in-process webhook retries and delivery-state recording"""
+
+    @pytest.mark.asyncio
+    async def test_transient_status_is_retried(self, worker):
+        """Test 5xx/429 responses are retried until one succeeds"""
+        post = AsyncMock(side_effect=[httpx.Response(503), httpx.Response(429), httpx.Response(200)])
+        with patch.object(worker._HTTP, "post", post):
+            r = await worker._post_webhook("https://rails.test/hook", b"{}")
+
+        assert r.status_code == 200
+        assert post.await_count == 3
+
+    @pytest.mark.asyncio
+    async def test_retries_stop_after_five_attempts(self, worker):
+        """Test a persistent 5xx returns the last response after 5 attempts"""
+        post = AsyncMock(return_value=httpx.Response(500))
+        with patch.object(worker._HTTP, "post", post):
+            r = await worker._post_webhook("https://rails.test/hook", b"{}")
+
+        assert r.status_code == 500
+        assert post.await_count == 5
+
+    @pytest.mark.asyncio
+    async def test_client_errors_are_not_retried(self, worker):
+        """Test 4xx (other than 429) is final"""
+        post = AsyncMock(return_value=httpx.Response(400))
+        with patch.object(worker._HTTP, "post", post):
+            r = await worker._post_webhook("https://rails.test/hook", b"{}")
+
+        assert r.status_code == 400
+        assert post.await_count == 1
+
+    @pytest.mark.asyncio
+    async def test_transport_errors_reraise_after_retries(self, worker):
+        """Test connection errors are retried, then raised"""
+        post = AsyncMock(side_effect=httpx.ConnectError("refused"))
+        with patch.object(worker._HTTP, "post", post):
+            with pytest.raises(httpx.ConnectError):
+                await worker._post_webhook("https://rails.test/hook", b"{}")
+
+        assert post.await_count == 5
+
+    @pytest.mark.asyncio
+    async def test_delivery_status_is_recorded(self, worker):
+        """Test delivered and failed outcomes are written to the job"""
+        with patch.object(worker, "set_webhook_status") as record:
+            with patch.object(worker._HTTP, "post", AsyncMock(return_value=httpx.Response(204))):
+                assert await worker._deliver_webhook("job-1", "https://rails.test/hook", b"{}") == "delivered"
+            with patch.object(worker._HTTP, "post", AsyncMock(side_effect=httpx.ConnectError("refused"))):
+                assert await worker._deliver_webhook("job-2", "https://rails.test/hook", b"{}") == "failed"
+
+        assert [c.args for c in record.call_args_list] == [("job-1", "delivered"), ("job-2", "failed")]
+
+
+    @pytest.mark.asyncio
+    async def test_invalid_url_and_status_errors_do_not_raise(self, worker):
+        """Test a malformed callback URL or a failed status write still returns 'failed'"""
+        with patch.object(worker, "set_webhook_status", side_effect=RuntimeError("supabase down")) as record:
+            assert await worker._deliver_webhook("job-1", "http://[::1", b"{}") == "failed"
+
+        record.assert_called_once_with("job-1", "failed")
+
+class TestSectionMap:
+    """Test section_map flattening and its per-job cache"""
+
+    @pytest.fixture(autouse=True)
+    def clear_cache(self, worker):
+        worker._SECTION_MAPS.clear()
+        yield
+        worker._SECTION_MAPS.clear()
+
+    def test_flattens_with_string_ids(self, worker):
+        """Test int and str question ids both normalize to str keys"""
+        flat = worker._normalized_section_map("job-1", {"essay": {"102": "Writing", 103: "Logic"}})
+        assert flat == {("essay", "102"): "Writing", ("essay", "103"): "Logic"}
+
+    def test_skips_empty_maps_and_missing_labels(self, worker):
+        """Test null/empty per-type maps and blank labels produce no entries"""
+        flat = worker._normalized_section_map("job-1", {"essay": {"1": "", "2": None}, "coding": None, "multiple_choice": {}})
+        assert flat == {}
+
+    def test_cached_per_task(self, worker):
+        """Test a retry of the same task reuses the flattened map, a new task gets its own"""
+        first = worker._normalized_section_map("task-job-1", {"essay": {"1": "A"}})
+        assert worker._normalized_section_map("task-job-1", {"essay": {"1": "A"}}) is first
+        # A resubmission (new task job_id) with a corrected map is never shadowed
+        assert worker._normalized_section_map("task-job-2", {"essay": {"1": "fixed"}}) == {("essay", "1"): "fixed"}
+
+    def test_cache_is_bounded(self, worker):
+        """Test the oldest job is evicted once the cache is full"""
+        with patch.object(worker, "_SECTION_MAPS_MAX", 2):
+            for job in ("a", "b", "c"):
+                worker._normalized_section_map(job, {"essay": {"1": job}})
+        assert list(worker._SECTION_MAPS) == ["b", "c"]
+
+
+class TestHmacHeaders:
+    """Test webhook signing from the pre-keyed HMAC template"""
+
+    def test_signature_matches_plain_hmac(self, worker):
+        """Test the copied template signs exactly like hmac.new over the same bytes"""
+        raw = b'{"job_id":"job-1","status":"succeeded"}'
+        template = hmac.new(b"webhook-secret", digestmod=hashlib.sha256)
+        with patch.object(worker, "_HMAC_TEMPLATE", template):
+            first = worker._hmac_headers(raw)
+            second = worker._hmac_headers(raw)  # template isn't consumed by a call
+
+        expected = hmac.new(b"webhook-secret", raw, hashlib.sha256).hexdigest()
+        assert first["X-Signature"] == second["X-Signature"] == f"sha256={expected}"
+        assert first["X-Key-Id"] == "python-v1"
+        assert first["X-Timestamp"].isdigit()
+
+    def test_no_secret_no_headers(self, worker):
+        """Test webhooks go unsigned without AI_WEBHOOK_SECRET"""
+        with patch.object(worker, "_HMAC_TEMPLATE", None):
+            assert worker._hmac_headers(b"{}") == {}